@@ -5,13 +5,20 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+from bson import json_util
+import redis.asyncio as redis
+import asyncio
+import logging
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import Any, Awaitable, Callable, List, Optional, TypeVar, Union
 from pydantic import BaseModel
 
+T = TypeVar("T")
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -22,28 +29,81 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Module-level singleton: the pool is shared by every request and never rebuilt.
+    # zstd needs the zstandard package; pymongo falls back to zlib/uncompressed.
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 200)),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 20)),
+        waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000)),
+        compressors="zstd,zlib",
+        retryWrites=True,
+        serverSelectionTimeoutMS=2000,
+    )
     db = _client[database_name]
 
+# Multi-document transactions need a replica set; keep them opt-in for single-node dev
+use_transactions = os.getenv("MONGO_TRANSACTIONS", "").lower() in ("1", "true", "yes")
+
+# Optional Redis cache for hot read endpoints; callers must tolerate it being None
+cache = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    cache = redis.Redis.from_url(redis_url)
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict], session=None):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
-    # Convert Pydantic model to dict if needed
+    # Convert Pydantic model to dict if needed; handlers that already dumped
+    # the payload pass the dict through so it is serialized only once
     if isinstance(data, BaseModel):
         data_dict = data.model_dump()
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict, session=session)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]], session=None):
+    """Insert many documents with timestamps in a single unordered batch
+
+    Returns ids aligned with items; entries whose insert failed are None.
+    """
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    if not items:
+        return []
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    failed = set()
+    try:
+        await db[collection_name].insert_many(docs, ordered=False, session=session)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if not write_errors:
+            raise
+        # Unordered: everything but the reported indexes was written
+        failed = {err["index"] for err in write_errors}
+    # insert_many assigns _id to each doc in place
+    return [None if i in failed else str(d["_id"]) for i, d in enumerate(docs)]
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +112,122 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
+
+async def run_transaction(callback: Callable[[Any], Awaitable[T]]) -> T:
+    """Run callback(session) in a transaction, or callback(None) when transactions are disabled
+
+    with_transaction retries the callback on TransientTransactionError (e.g. write
+    conflicts on shared counters) and the commit on UnknownTransactionCommitResult.
+    """
+    if not use_transactions or _client is None:
+        return await callback(None)
+    async with await _client.start_session() as session:
+        return await session.with_transaction(callback)
+
+# ---------- Batched audit log writer ----------
+
+AUDIT_BATCH_SIZE = 100
+AUDIT_FLUSH_INTERVAL = 0.05  # seconds
+AUDIT_MAX_ATTEMPTS = 4
+AUDIT_RETRY_DELAY = 0.5  # seconds, doubled per attempt
+# Batches that still fail are appended here as extended JSON for replay
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", "logs/audit_spill.jsonl")
+
+logger = logging.getLogger(__name__)
+
+_audit_queue: Optional[asyncio.Queue] = None
+_audit_task: Optional[asyncio.Task] = None
+
+async def audit(entry: Union[BaseModel, dict]):
+    """Queue an audit log document for batched insertion"""
+    if _audit_queue is None:
+        # Writer not running (e.g. outside the app lifecycle): write through
+        await create_document("auditlog", entry)
+        return
+
+    if isinstance(entry, BaseModel):
+        data_dict = entry.model_dump()
+    else:
+        data_dict = entry.copy()
+
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+
+    _audit_queue.put_nowait(data_dict)
+
+def _spill_audit(batch: list):
+    try:
+        os.makedirs(os.path.dirname(AUDIT_SPILL_PATH) or ".", exist_ok=True)
+        with open(AUDIT_SPILL_PATH, "a", encoding="utf-8") as f:
+            for doc in batch:
+                f.write(json_util.dumps(doc) + "\n")
+        logger.error("Spilled %d audit log entries to %s", len(batch), AUDIT_SPILL_PATH)
+    except Exception:
+        logger.critical("Lost %d audit log entries: %s", len(batch), json_util.dumps(batch), exc_info=True)
+
+async def _flush_audit(batch: list):
+    pending = batch
+    for attempt in range(AUDIT_MAX_ATTEMPTS):
+        try:
+            await db["auditlog"].insert_many(pending, ordered=False)
+            return
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if write_errors:
+                # _id is assigned on the first attempt, so a duplicate key means
+                # that entry was already written; retry only the real failures
+                failed = {err["index"] for err in write_errors if err.get("code") != 11000}
+                pending = [doc for i, doc in enumerate(pending) if i in failed]
+                if not pending:
+                    return
+            logger.warning("Audit log write failed (attempt %d): %s", attempt + 1, e)
+        except Exception as e:
+            logger.warning("Audit log write failed (attempt %d): %s", attempt + 1, e)
+        if attempt + 1 < AUDIT_MAX_ATTEMPTS:
+            await asyncio.sleep(AUDIT_RETRY_DELAY * 2 ** attempt)
+    await asyncio.to_thread(_spill_audit, pending)
+
+async def _audit_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        doc = await _audit_queue.get()
+        if doc is None:
+            return
+        batch = [doc]
+        deadline = loop.time() + AUDIT_FLUSH_INTERVAL
+        stop = False
+        while len(batch) < AUDIT_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                doc = await asyncio.wait_for(_audit_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if doc is None:
+                stop = True
+                break
+            batch.append(doc)
+        await _flush_audit(batch)
+        if stop:
+            return
+
+def start_audit_writer():
+    """Start the background task that flushes queued audit logs"""
+    global _audit_queue, _audit_task
+    if db is None or _audit_task is not None:
+        return
+    _audit_queue = asyncio.Queue()
+    _audit_task = asyncio.get_running_loop().create_task(_audit_writer())
+
+async def stop_audit_writer():
+    """Flush pending audit logs and stop the background writer"""
+    global _audit_queue, _audit_task
+    if _audit_task is None:
+        return
+    _audit_queue.put_nowait(None)
+    await _audit_task
+    _audit_queue = None
+    _audit_task = None
@@ -1,11 +1,23 @@
 import os
+import functools
+import math
+import logging
+import json
+import time
+import asyncio
 from datetime import datetime, timedelta, timezone
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, Any
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from bson import ObjectId
+from bson.errors import InvalidId
+from typing import Dict, Any, List, Optional
 
-from database import db, create_document, get_documents
+from database import db, cache, create_document, create_documents, get_documents, run_transaction, audit, start_audit_writer, stop_audit_writer
 from schemas import (
     Patient,
     TriageEvent,
@@ -24,7 +36,26 @@ from schemas import (
     PayrollRecord,
 )
 
-app = FastAPI(title="RS Rujukan Regional - Hospital 4.0 API")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="RS Rujukan Regional - Hospital 4.0 API", default_response_class=ORJSONResponse)
+
+# BOR counters are kept as a materialized view in stats/{_id: "bor"},
+# updated alongside every room, admission and discharge write. Without
+# MONGO_TRANSACTIONS a partial failure can leave them off, and rooms may be
+# loaded out of band, so they are rebuilt from `room` on every startup and
+# on demand via POST /dashboard/bor/recompute
+BOR_STATS_ID = "bor"
+BOR_CACHE_KEY = "dashboard:bor"
+BOR_CACHE_TTL = 15  # seconds; dashboards tolerate brief staleness
+
+async def invalidate_bor_cache():
+    if cache is None:
+        return
+    try:
+        await cache.delete(BOR_CACHE_KEY)
+    except Exception:
+        pass
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,12 +65,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    indexes = [
+        ("room", "code", {"unique": True}),
+        ("inventoryitem", "sku", {"unique": True}),
+        ("patient", "national_mrn", {"unique": True}),
+        ("admission", "patient_id", {}),
+        ("auditlog", [("entity", 1), ("entity_id", 1)], {}),
+        ("shift", [("staff_id", 1), ("start", 1)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await db[collection].create_index(keys, **options)
+        except PyMongoError:
+            # e.g. existing duplicates block a unique index; serve without it
+            logger.exception("Could not create index %s on %s", keys, collection)
+
+async def recompute_bor_stats():
+    docs = await db["room"].aggregate([
+        {"$group": {"_id": None, "total": {"$sum": "$bed_count"}, "occ": {"$sum": "$occupied_beds"}}}
+    ]).to_list(length=1)
+    res = docs[0] if docs else {"total": 0, "occ": 0}
+    await db["stats"].update_one(
+        {"_id": BOR_STATS_ID},
+        {"$set": {"total_beds": res["total"], "occupied": res["occ"]}},
+        upsert=True,
+    )
+    await invalidate_bor_cache()
+    return res
+
+@app.on_event("startup")
+async def seed_bor_stats():
+    if db is None:
+        return
+    await recompute_bor_stats()
+
+@app.on_event("startup")
+async def start_background_writers():
+    start_audit_writer()
+
+@app.on_event("shutdown")
+async def flush_background_writers():
+    await stop_audit_writer()
+
 @app.get("/")
 def read_root():
     return {"message": "RS Rujukan Regional API running"}
 
+COLLECTIONS_CACHE_TTL = 30  # seconds
+_coll_cache = {"t": float("-inf"), "v": []}  # -inf: never fetched, even right after boot
+_coll_lock = asyncio.Lock()
+
+async def cached_collection_names():
+    async with _coll_lock:
+        if time.monotonic() - _coll_cache["t"] >= COLLECTIONS_CACHE_TTL:
+            # nameOnly skips collection metadata; stop reading after the 20 we show
+            cursor = await db.list_collections(filter={}, nameOnly=True)
+            _coll_cache["v"] = [c["name"] for c in await cursor.to_list(length=20)]
+            _coll_cache["t"] = time.monotonic()
+        return _coll_cache["v"]
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -55,8 +145,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:20]
+                response["collections"] = await cached_collection_names()
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:80]}"
@@ -70,66 +159,146 @@ def test_database():
 
 # 1) Create patient profile
 @app.post("/patients")
-def create_patient(payload: Patient):
-    pid = create_document("patient", payload)
-    create_document("auditlog", AuditLog(action="create", entity="patient", entity_id=pid, meta={"source": "api"}))
+async def create_patient(payload: Patient):
+    try:
+        pid = await create_document("patient", payload)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Patient with this national_mrn already exists")
+    await audit(AuditLog(action="create", entity="patient", entity_id=pid, meta={"source": "api"}))
     return {"id": pid}
 
 # 2) Triage event with automatic consent handling
-@app.post("/triage")
-def triage(payload: TriageEvent):
+@functools.lru_cache(maxsize=2048)
+def is_critical(gcs: Optional[int], spo2: Optional[int]) -> bool:
+    # GCS is 3-15 and SpO2 is truncated to whole percent (x < 90 iff int(x) < 90),
+    # so the input domain is small enough to memoize as a lookup table
+    return (gcs is not None and gcs <= 8) or (spo2 is not None and spo2 < 90)
+
+def spo2_bucket(spo2: Optional[float]) -> Optional[int]:
+    # NaN compares false like a missing reading; clamping to 0-100 keeps -inf
+    # critical and +inf not, and int() never sees a non-finite value
+    if spo2 is None or math.isnan(spo2):
+        return None
+    return int(min(max(spo2, 0.0), 100.0))
+
+def apply_triage_protocol(payload: TriageEvent):
     data = payload.model_dump()
-    critical = False
-    if payload.gcs is not None and payload.gcs <= 8:
-        critical = True
-    spo2 = payload.vital_signs.get("spo2") if payload.vital_signs else None
-    if spo2 is not None and spo2 < 90:
-        critical = True
+    spo2 = (payload.vital_signs or {}).get("spo2")
+    critical = is_critical(payload.gcs, spo2_bucket(spo2))
     if critical and not payload.consent_emergency_protocol:
         data["consent_emergency_protocol"] = True
-        data.setdefault("critical_flags", []).append("auto_consent_emergency_protocol")
-    tid = create_document("triageevent", data)
-    create_document("auditlog", AuditLog(action="create", entity="triageevent", entity_id=tid))
+        data["critical_flags"] = [*data.get("critical_flags", []), "auto_consent_emergency_protocol"]
+    return data, critical
+
+@app.post("/triage")
+async def triage(payload: TriageEvent):
+    data, critical = apply_triage_protocol(payload)
+    tid = await create_document("triageevent", data)
+    await audit(AuditLog(action="create", entity="triageevent", entity_id=tid))
     return {"id": tid, "critical": critical, "consent": data.get("consent_emergency_protocol", False)}
 
+@app.post("/triage/batch")
+async def triage_batch(payloads: List[TriageEvent]):
+    processed = [apply_triage_protocol(p) for p in payloads]
+    tids = await create_documents("triageevent", [data for data, _ in processed])
+    for tid in tids:
+        if tid is not None:
+            await audit(AuditLog(action="create", entity="triageevent", entity_id=tid))
+    return {
+        "items": [
+            {"id": tid, "critical": critical, "consent": data.get("consent_emergency_protocol", False)}
+            for tid, (data, critical) in zip(tids, processed)
+        ],
+        "failed": [i for i, tid in enumerate(tids) if tid is None],
+    }
+
 # 3) Admission and room tracking
+@app.post("/rooms")
+async def create_room(payload: Room):
+    async def insert_room(session):
+        rid = await create_document("room", payload, session=session)
+        await db["stats"].update_one(
+            {"_id": BOR_STATS_ID},
+            {"$inc": {"total_beds": payload.bed_count, "occupied": payload.occupied_beds}},
+            upsert=True,
+            session=session,
+        )
+        return rid
+
+    try:
+        rid = await run_transaction(insert_room)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Room with this code already exists")
+    await invalidate_bor_cache()
+    await audit(AuditLog(action="create", entity="room", entity_id=rid))
+    return {"id": rid}
+
 @app.post("/admissions")
-def create_admission(payload: Admission):
-    # Basic bed availability check
-    room = db["room"].find_one({"code": payload.room_code})
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-    if room.get("occupied_beds", 0) >= room.get("bed_count", 0):
-        raise HTTPException(status_code=409, detail="No available bed")
-    aid = create_document("admission", payload)
-    db["room"].update_one({"code": payload.room_code}, {"$inc": {"occupied_beds": 1}})
-    create_document("auditlog", AuditLog(action="create", entity="admission", entity_id=aid))
+async def create_admission(payload: Admission):
+    async def admit(session):
+        # Claim a bed atomically: only increments while a bed is still free
+        room = await db["room"].find_one_and_update(
+            {"code": payload.room_code, "$expr": {"$lt": ["$occupied_beds", "$bed_count"]}},
+            {"$inc": {"occupied_beds": 1}},
+            projection={"_id": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if room is None:
+            if not await db["room"].find_one({"code": payload.room_code}, {"_id": 1}, session=session):
+                raise HTTPException(status_code=404, detail="Room not found")
+            raise HTTPException(status_code=409, detail="No available bed")
+        await db["stats"].update_one({"_id": BOR_STATS_ID}, {"$inc": {"occupied": 1}}, upsert=True, session=session)
+        return await create_document("admission", payload, session=session)
+
+    aid = await run_transaction(admit)
+    await invalidate_bor_cache()
+    await audit(AuditLog(action="create", entity="admission", entity_id=aid))
     return {"id": aid}
 
 @app.post("/admissions/{admission_id}/discharge")
-def discharge(admission_id: str):
-    adm = db["admission"].find_one({"_id": {"$eq": db["admission"].codec_options.document_class()._id} }) if False else None
-    # simple discharge: decrement bed
-    admission = db["admission"].find_one({"_id": {"$oid": admission_id}})
-    if not admission:
-        # fallback simple find by string id, for viewer context ignore ObjectId parsing
-        admission = db["admission"].find_one({"id": admission_id})
-    if not admission:
-        raise HTTPException(status_code=404, detail="Admission not found")
-    db["room"].update_one({"code": admission.get("room_code")}, {"$inc": {"occupied_beds": -1}})
-    db["admission"].update_one({"_id": admission.get("_id")}, {"$set": {"end": datetime.now(timezone.utc)}})
-    create_document("auditlog", AuditLog(action="update", entity="admission", entity_id=admission_id, meta={"op": "discharge"}))
+async def discharge(admission_id: str):
+    try:
+        q = {"_id": ObjectId(admission_id)}
+    except InvalidId:
+        # fallback simple find by string id
+        q = {"id": admission_id}
+    # Close the admission and read its room in one round trip. discharged_at is only
+    # ever set here, so a planned `end` doesn't block discharge and beds are never
+    # released twice
+    async def close_admission(session):
+        now = datetime.now(timezone.utc)
+        admission = await db["admission"].find_one_and_update(
+            {**q, "discharged_at": None},
+            {"$set": {"end": now, "discharged_at": now}},
+            projection={"room_code": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if not admission:
+            if await db["admission"].find_one(q, {"_id": 1}, session=session):
+                raise HTTPException(status_code=409, detail="Admission already discharged")
+            raise HTTPException(status_code=404, detail="Admission not found")
+        await db["room"].update_one(
+            {"code": admission.get("room_code")}, {"$inc": {"occupied_beds": -1}}, session=session
+        )
+        await db["stats"].update_one({"_id": BOR_STATS_ID}, {"$inc": {"occupied": -1}}, upsert=True, session=session)
+
+    await run_transaction(close_admission)
+    await invalidate_bor_cache()
+    await audit(AuditLog(action="update", entity="admission", entity_id=admission_id, meta={"op": "discharge"}))
     return {"status": "ok"}
 
 # 4) Procedures with sterile workflow
 @app.post("/procedures")
-def create_procedure(payload: Procedure):
+async def create_procedure(payload: Procedure):
     data = payload.model_dump()
     if payload.requires_sterile and not payload.sterile_batch:
-        data["sterile_batch"] = f"AUTO-{int(datetime.now().timestamp())}"
-        data["cssd_return_due"] = (datetime.now(timezone.utc) + timedelta(hours=8)).isoformat()
-    pid = create_document("procedure", data)
-    create_document("auditlog", AuditLog(action="create", entity="procedure", entity_id=pid))
+        now = datetime.now(timezone.utc)
+        data["sterile_batch"] = f"AUTO-{int(now.timestamp())}"
+        data["cssd_return_due"] = (now + timedelta(hours=8)).isoformat()
+    pid = await create_document("procedure", data)
+    await audit(AuditLog(action="create", entity="procedure", entity_id=pid))
     return {"id": pid}
 
 # 5) Pharmacy: validate prescription and stock status
@@ -137,49 +306,114 @@ class PrescriptionValidateRequest(BaseModel):
     prescription: Prescription
 
 @app.post("/pharmacy/validate")
-def validate_prescription(req: PrescriptionValidateRequest):
+async def validate_prescription(req: PrescriptionValidateRequest):
     p = req.prescription
-    # Simple allergy and interaction checker stub
-    allergen_set = {a.substance.lower() for a in db["patient"].find_one({"_id": {"$exists": False}}) or []} if False else set()
-    items = p.items
-    out_of_stock = []
-    for it in items:
-        sku = it.get("drug") or it.get("sku")
-        inv = db["inventoryitem"].find_one({"sku": sku})
-        if not inv or inv.get("stock", 0) <= 0:
-            out_of_stock.append(sku)
-    status = "validated" if not out_of_stock else "out_of_stock_external"
-    return {"status": status, "out_of_stock": out_of_stock}
+    skus = [it.get("drug") or it.get("sku") for it in p.items]
+    drugs = [str(it["drug"]).lower() for it in p.items if it.get("drug")]
+    try:
+        patient_key = ObjectId(p.patient_id)
+    except InvalidId:
+        patient_key = p.patient_id
+    # Stock and allergy checks joined server-side: one round trip regardless of item count
+    pipeline = [
+        {"$documents": [{"skus": skus, "drugs": drugs, "patient_id": patient_key}]},
+        {"$lookup": {
+            "from": "inventoryitem", "localField": "skus", "foreignField": "sku",
+            "pipeline": [{"$match": {"stock": {"$gt": 0}}}, {"$project": {"sku": 1, "_id": 0}}],
+            "as": "inv",
+        }},
+        {"$lookup": {
+            "from": "patient", "localField": "patient_id", "foreignField": "_id",
+            "pipeline": [{"$project": {"allergies.substance": 1}}],
+            "as": "pat",
+        }},
+        {"$project": {
+            "_id": 0,
+            "in_stock": "$inv.sku",
+            "allergy_hits": {"$setIntersection": ["$drugs", {"$map": {
+                "input": {"$ifNull": [{"$first": "$pat.allergies.substance"}, []]},
+                "in": {"$toLower": "$$this"},
+            }}]},
+        }},
+    ]
+    docs = await db.aggregate(pipeline).to_list(length=1)
+    res = docs[0] if docs else {}
+    in_stock = set(res.get("in_stock", []))
+    allergy_hits = res.get("allergy_hits", [])
+    out_of_stock = [s for s in skus if s not in in_stock]
+    # An allergy conflict needs clinician review and outranks stock status
+    if allergy_hits:
+        status = "allergy_conflict"
+    else:
+        status = "validated" if not out_of_stock else "out_of_stock_external"
+    return {
+        "status": status,
+        "out_of_stock": out_of_stock,
+        "allergy_conflict": bool(allergy_hits),
+        "allergy_hits": allergy_hits,
+    }
 
 # 6) External lab result intake (simulated)
 @app.post("/labs/external/callback")
-def external_lab_result(payload: LabResult):
-    rid = create_document("labresult", payload)
-    create_document("auditlog", AuditLog(action="create", entity="labresult", entity_id=rid, meta={"source": "external"}))
+async def external_lab_result(payload: LabResult):
+    rid = await create_document("labresult", payload)
+    await audit(AuditLog(action="create", entity="labresult", entity_id=rid, meta={"source": "external"}))
     return {"id": rid}
 
+@app.post("/labs/external/callback/batch")
+async def external_lab_results(payloads: List[LabResult]):
+    rids = await create_documents("labresult", payloads)
+    # Queued audit entries are flushed together by the batched writer
+    for rid in rids:
+        if rid is not None:
+            await audit(AuditLog(action="create", entity="labresult", entity_id=rid, meta={"source": "external"}))
+    return {
+        "items": [{"id": rid} for rid in rids],
+        "failed": [i for i, rid in enumerate(rids) if rid is None],
+    }
+
 # 7) Simple dashboards
 @app.get("/dashboard/bor")
-def dashboard_bor():
-    total_beds = 0
-    occupied = 0
-    for r in db["room"].find({}):
-        total_beds += r.get("bed_count", 0)
-        occupied += r.get("occupied_beds", 0)
-    return {"total_beds": total_beds, "occupied": occupied, "bor": (occupied / total_beds * 100) if total_beds else 0}
+async def dashboard_bor():
+    if cache is not None:
+        try:
+            cached = await cache.get(BOR_CACHE_KEY)
+            if cached is not None:
+                return json.loads(cached)
+        except Exception:
+            pass
+    stats = await db["stats"].find_one({"_id": BOR_STATS_ID}) or {}
+    total_beds = stats.get("total_beds", 0)
+    occupied = stats.get("occupied", 0)
+    result = {"total_beds": total_beds, "occupied": occupied, "bor": (occupied / total_beds * 100) if total_beds else 0}
+    if cache is not None:
+        try:
+            await cache.setex(BOR_CACHE_KEY, BOR_CACHE_TTL, json.dumps(result))
+        except Exception:
+            pass
+    return result
+
+@app.post("/dashboard/bor/recompute")
+async def dashboard_bor_recompute():
+    res = await recompute_bor_stats()
+    return {"total_beds": res["total"], "occupied": res["occ"]}
+
+# Minimal exposure so tools/viewers can read collection names; encoded once at import
+SCHEMA_BYTES = orjson.dumps({
+    "collections": [
+        "patient", "triageevent", "staff", "shift", "room", "admission",
+        "inventoryitem", "procedure", "laborder", "labresult", "prescription",
+        "auditlog", "insuranceclaim", "governmentreport", "payrollrecord"
+    ]
+})
 
 @app.get("/schema")
 def get_schema():
-    # Minimal exposure so tools/viewers can read collection names
-    return {
-        "collections": [
-            "patient", "triageevent", "staff", "shift", "room", "admission",
-            "inventoryitem", "procedure", "laborder", "labresult", "prescription",
-            "auditlog", "insuranceclaim", "governmentreport", "payrollrecord"
-        ]
-    }
+    return Response(content=SCHEMA_BYTES, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WORKERS", os.cpu_count() or 1))
+    # Multiple workers require the app as an import string
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)